@@ -2,9 +2,11 @@ import os
 import pathlib
 
 import click
+import numpy as np
 import rasterio
+from rasterio.env import GDALVersion
+from rasterio.vrt import WarpedVRT
 from rasterio.warp import Resampling
-from rasterio.windows import from_bounds
 
 from geospatial_tools import DATA_DIR
 
@@ -23,6 +25,27 @@ def get_source_information(source_image: pathlib.Path):
     return source_bounds, source_crs, source_height, source_transform, source_width
 
 
+def _gtiff_profile(meta: dict) -> dict:
+    # Tiled and compressed output, so downstream windowed reads stay block aligned and
+    # GDAL can compress blocks on all CPUs while writing
+    profile = meta.copy()
+    compression = "zstd" if GDALVersion.runtime().at_least("3.1") else "deflate"
+    predictor = 3 if np.issubdtype(np.dtype(profile["dtype"]), np.floating) else 2
+    profile.update(
+        {
+            "driver": "GTiff",
+            "tiled": True,
+            "blockxsize": 512,
+            "blockysize": 512,
+            "compress": compression,
+            "predictor": predictor,
+            "num_threads": "ALL_CPUS",
+            "BIGTIFF": "IF_SAFER",
+        }
+    )
+    return profile
+
+
 @click.command(context_settings={"show_default": True})
 @click.option(
     "--source-image",
@@ -45,7 +68,7 @@ def resample_tiff(source_image: str, resample_target: str, output_path: str):
     resample_target = pathlib.Path(resample_target)
     output_path = pathlib.Path(output_path)
 
-    source_bounds, source_crs, source_height, source_transform, source_width = get_source_information(source_image)
+    _, source_crs, source_height, source_transform, source_width = get_source_information(source_image)
 
     with rasterio.open(resample_target) as resample:
         resample_target_crs = resample.crs
@@ -55,28 +78,37 @@ def resample_tiff(source_image: str, resample_target: str, output_path: str):
         if resample_target_crs != source_crs:
             raise ValueError("CRS does not match, reproject 'source' to match 'target'")
 
-        print("Creating window to clip dsm ortho")
-        window = from_bounds(*source_bounds, transform=resample.transform)
-
         # Prepare to resample the source image
         kwargs = resample.meta.copy()
         kwargs.update(
-            {"crs": resample_target_crs, "transform": source_transform, "width": source_width, "height": source_height}
+            {
+                "crs": resample_target_crs,
+                "transform": source_transform,
+                "width": source_width,
+                "height": source_height,
+            }
         )
 
         print("Resampling dsm ortho")
-        with rasterio.open(output_path / "resampled_dsm_ortho.tif", "w", **kwargs) as resampled:
-            # Sample didn't include more than 1 band, but just in case...
-            for i in range(1, resample.count + 1):
-                # Read each band from the source and resample it
-                resampled_band = resample.read(
-                    i,
-                    window=window,
-                    out_shape=(source_height, source_width),
-                    resampling=Resampling.nearest,
-                    out_dtype="float32",
-                )
-                resampled.write(resampled_band, i)
+        # Warp through a VRT and write one output block at a time, so memory use stays constant
+        # regardless of raster size while GDAL still warps each block on multiple threads
+        with WarpedVRT(
+            resample,
+            crs=source_crs,
+            transform=source_transform,
+            width=source_width,
+            height=source_height,
+            resampling=Resampling.nearest,
+            warp_mem_limit=512,
+            num_threads=os.cpu_count(),
+        ) as vrt:
+            with rasterio.open(output_path / "resampled_dsm_ortho.tif", "w", **_gtiff_profile(kwargs)) as resampled:
+                # Keep the target's native dtype, scale and offset so consumers can still apply
+                # the scaling on read, instead of widening every block to float32
+                resampled.scales = resample.scales
+                resampled.offsets = resample.offsets
+                for _, window in resampled.block_windows(1):
+                    resampled.write(vrt.read(window=window), window=window)
 
 
 if __name__ == "__main__":